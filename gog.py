@@ -1,11 +1,28 @@
 import os
+import re
+import sys
 import time
+import heapq
+import hmac
+import select
 import threading
 import psycopg2
+import psycopg2.extensions
 import telebot
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from flask import Flask, request
+from requests.exceptions import RequestException
+from urllib.parse import urlparse
 from contextlib import contextmanager
-from queue import Queue
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from collections import defaultdict, namedtuple
+from cachetools import TTLCache
+try:
+    import ahocorasick
+except ImportError:  # fall back to a compiled regex alternation
+    ahocorasick = None
 from telebot.types import (
     InputMediaPhoto,
     InputMediaVideo,
@@ -20,29 +37,118 @@ album_timers = {}
 
 API_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # unset -> long polling
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # required with WEBHOOK_URL
+PORT = int(os.getenv("PORT", "8080"))
 ADMIN_ID = 8010306055  #  Replace with your Telegram ID
-
-bot = telebot.TeleBot(API_TOKEN)
-
-media_groups = defaultdict(list)
-waiting_username = set()
-broadcast_queue = Queue()
+ALBUM_WAIT = 0.8  # seconds to wait for all parts of a media group
+HANDLER_THREADS = 8  # concurrent update handlers
+BROADCAST_WORKERS = 4  # broadcasts in flight
+CALLBACK_WORKERS = 2  # album activation/recovery replies in flight
+SEND_WORKERS = 16  # concurrent per-recipient sends
+SEND_RATE = 25  # sends/sec across all chats (Telegram caps at ~30)
+SEND_RATE_PER_CHAT = 1  # sends/sec to any one chat
+MAP_FLUSH_INTERVAL = 0.2  # max seconds a message_map row waits
+MAP_FLUSH_ROWS = 500  # rows per message_map INSERT
+MAP_FLUSH_RETRIES = 6  # attempts per batch, backing off 1s, 2s, 4s...
+INACTIVE_AFTER = 60*5  # seconds without media before auto-ban
+INACTIVITY_CHECK_INTERVAL = 60  # seconds between inactivity sweeps
+PROGRESS_STEP = 4  # "N media left" is sent every PROGRESS_STEP media
+
+# Admin commands trust chat.id alone, so forged POSTs must be refused
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    sys.exit("WEBHOOK_SECRET must be set when WEBHOOK_URL is")
+
+bot = telebot.TeleBot(API_TOKEN, threaded=True, num_threads=HANDLER_THREADS)
+
+# Bounded + expiring so abandoned albums / signups can't grow forever.
+# TTLCache is not thread-safe: touch these only under state_lock.
+media_groups = TTLCache(maxsize=1000, ttl=5)
+waiting_username = TTLCache(maxsize=10000, ttl=600)
+progress_notified = TTLCache(maxsize=10000, ttl=3600)  # uid -> remaining
+state_lock = threading.Lock()
+message_map_queue = Queue()
+
+# Pending album flushes: (deadline, group_id, executor, on_complete),
+# a min-heap drained by the single album_flusher thread.
+album_heap = []
+album_cond = threading.Condition(state_lock)
 
 # =========================================================
 # 🗄 DATABASE CONNECTION
 # =========================================================
 
-conn = psycopg2.connect(DATABASE_URL)
+# Hot statements, parsed and planned once per pooled session.
+PREPARED_STATEMENTS = [
+    """
+    PREPARE q_user_state(bigint) AS
+    SELECT banned, auto_banned, shadow_banned,
+           whitelisted, media_count, username
+    FROM users WHERE user_id=$1
+    """,
+    # Touch activity and, if auto-banned and back at 12, reactivate.
+    # The CTE exposes the pre-update auto_banned to RETURNING.
+    """
+    PREPARE q_media_activity(bigint, integer, bigint) AS
+    WITH old AS (
+        SELECT auto_banned FROM users WHERE user_id=$3 FOR UPDATE
+    )
+    UPDATE users u
+    SET last_media=$1,
+        media_count = CASE
+            WHEN u.auto_banned AND u.media_count + $2 >= 12 THEN 12
+            ELSE u.media_count + $2
+        END,
+        auto_banned = CASE
+            WHEN u.auto_banned AND u.media_count + $2 >= 12 THEN FALSE
+            ELSE u.auto_banned
+        END
+    FROM old
+    WHERE u.user_id=$3
+    RETURNING old.auto_banned, u.media_count
+    """,
+    "PREPARE q_username_taken(text) AS SELECT 1 FROM users WHERE username=$1",
+    """
+    PREPARE q_original_user(bigint) AS
+    SELECT original_user_id FROM message_map
+    WHERE bot_message_id=$1
+    """,
+]
 
-conn.autocommit = False
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """
+    Pooled connection that remembers whether it ran PREPARED_STATEMENTS
+    and keeps one long-lived cursor for read-only helpers.
+    """
+    prepared = False
+    _read_cursor = None
+
+    def read_cursor(self):
+        if self._read_cursor is None or self._read_cursor.closed:
+            self._read_cursor = self.cursor()
+        return self._read_cursor
+
+
+# getconn() raises instead of waiting, so size the pool for every
+# thread that borrows: handlers, both executors, map writer, sweeper.
+pool = ThreadedConnectionPool(
+    minconn=2,
+    maxconn=HANDLER_THREADS + BROADCAST_WORKERS + CALLBACK_WORKERS + 2,
+    dsn=DATABASE_URL,
+    connection_factory=PreparedConnection
+)
 
 # =========================================================
 # 🏗 DATABASE INITIALIZATION
 # =========================================================
 
-def init_db():
+def init_db(conn):
     with conn.cursor() as c:
 
+        # Processes booting together run this one at a time
+        c.execute("SELECT pg_advisory_xact_lock(hashtext('gog.init_db'))")
+
         c.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
@@ -77,6 +183,69 @@ def init_db():
             )
         """)
 
+        # Indexes for the hot WHERE clauses
+        c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_users_active
+            ON users(user_id)
+            WHERE banned=FALSE AND auto_banned=FALSE
+        """)
+
+        # Per-user lookups served from the index alone
+        c.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS users_pk_covering
+            ON users(user_id)
+            INCLUDE (media_count, auto_banned, banned, whitelisted,
+                     shadow_banned, username, last_media)
+        """)
+
+        # Only rows the inactivity sweep can still flip
+        c.execute("DROP INDEX IF EXISTS idx_users_last_media")
+        c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_users_inactive_sweep
+            ON users(last_media)
+            WHERE banned=FALSE AND whitelisted=FALSE AND auto_banned=FALSE
+        """)
+
+        c.execute("""
+            CREATE INDEX IF NOT EXISTS idx_message_map_orig
+            ON message_map(original_user_id)
+        """)
+
+        # Tell every bot process when the broadcast audience changes
+        c.execute("""
+            CREATE OR REPLACE FUNCTION notify_users_changed()
+            RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('users_changed', '');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+
+        # CREATE TRIGGER locks users exclusively: only do it once
+        c.execute("""
+            SELECT tgname FROM pg_trigger
+            WHERE tgrelid='users'::regclass AND NOT tgisinternal
+        """)
+        triggers = {r[0] for r in c.fetchall()}
+
+        if "users_changed_rows" not in triggers:
+            c.execute("""
+                CREATE TRIGGER users_changed_rows
+                AFTER INSERT OR DELETE ON users
+                FOR EACH ROW EXECUTE FUNCTION notify_users_changed()
+            """)
+
+        if "users_changed_flags" not in triggers:
+            c.execute("""
+                CREATE TRIGGER users_changed_flags
+                AFTER UPDATE OF banned, auto_banned ON users
+                FOR EACH ROW
+                WHEN (OLD.banned IS DISTINCT FROM NEW.banned
+                      OR OLD.auto_banned IS DISTINCT FROM NEW.auto_banned)
+                EXECUTE FUNCTION notify_users_changed()
+            """)
+
         c.execute("""
             INSERT INTO settings (key,value)
             VALUES ('join_open','true')
@@ -84,23 +253,156 @@ def init_db():
         """)
 
         conn.commit()
+def _prepare_statements(conn):
+    with conn.cursor() as c:
+        for sql in PREPARED_STATEMENTS:
+            c.execute(sql)
+    conn.commit()
+    conn.prepared = True
+
+
 @contextmanager
-def get_connection():
-    conn = psycopg2.connect(DATABASE_URL)
+def get_connection(prepare=True):
+    """Borrow a pooled connection; commit on success, rollback on error."""
+    conn = pool.getconn()
     try:
+        if prepare and not conn.prepared:
+            _prepare_statements(conn)
         yield conn
         conn.commit()
     except:
         conn.rollback()
         raise
     finally:
-        conn.close()
-init_db()
+        pool.putconn(conn)
+
+
+# Tables must exist before any session can PREPARE against them
+with get_connection(prepare=False) as init_conn:
+    init_db(init_conn)
 
 # =========================================================
 # 📦 DATABASE HELPERS
 # =========================================================
 
+# =========================
+# 🔎 READ HELPERS
+# =========================
+def _fetchone(sql, params=None):
+    """Run a read-only query on a pooled connection's reused cursor."""
+    with get_connection() as conn:
+        c = conn.read_cursor()
+        c.execute(sql, params)
+        return c.fetchone()
+
+
+def _fetchall(sql, params=None):
+    with get_connection() as conn:
+        c = conn.read_cursor()
+        c.execute(sql, params)
+        return c.fetchall()
+
+
+# =========================
+# 🧠 IN-MEMORY CACHES
+# =========================
+def _new_cache(ttl=None):
+    """ttl=None: kept until explicitly cleared (locally or via NOTIFY)."""
+    return {"t": 0, "v": None, "ttl": ttl, "lock": threading.Lock()}
+
+
+_users_cache = _new_cache()
+_words_cache = _new_cache()
+_admin_cache = _new_cache()
+
+# Postgres NOTIFY channel -> cache it invalidates
+CACHE_CHANNELS = {
+    "banned_words_changed": _words_cache,
+    "users_changed": _users_cache,
+    "admin_changed": _admin_cache,
+}
+
+
+def _cache_get(cache):
+    """Return cached value or None if empty/expired."""
+    if cache["v"] is None:
+        return None
+    if cache["ttl"] is not None and time.monotonic() - cache["t"] >= cache["ttl"]:
+        return None
+    return cache["v"]
+
+
+def _cached(cache, load):
+    """
+    Return the cached value, refilling it with load() when empty or
+    expired. One thread refills at a time, and _cache_clear waits for
+    an in-flight refill so a stale value is never kept.
+    """
+    value = _cache_get(cache)
+    if value is not None:
+        return value
+
+    with cache["lock"]:
+        value = _cache_get(cache)
+        if value is not None:
+            return value
+
+        value = load()
+        cache["t"] = time.monotonic()
+        cache["v"] = value
+
+        return value
+
+
+def _cache_clear(cache):
+    with cache["lock"]:
+        cache["v"] = None
+
+
+def cache_listener():
+    """
+    LISTEN on CACHE_CHANNELS so caches in every bot process are
+    cleared when any process changes the underlying table.
+    """
+    while True:
+        listen_conn = None
+        try:
+            # Keepalives so a dead peer is noticed in ~1 min, not hours
+            listen_conn = psycopg2.connect(
+                DATABASE_URL,
+                keepalives=1,
+                keepalives_idle=30,
+                keepalives_interval=10,
+                keepalives_count=3
+            )
+            listen_conn.autocommit = True
+
+            with listen_conn.cursor() as c:
+                for channel in CACHE_CHANNELS:
+                    c.execute(f"LISTEN {channel}")
+
+            # Anything may have changed while we weren't listening
+            for cache in CACHE_CHANNELS.values():
+                _cache_clear(cache)
+
+            while True:
+                if select.select([listen_conn], [], [], 60) == ([], [], []):
+                    # Quiet for a minute: make sure the link is still up
+                    with listen_conn.cursor() as c:
+                        c.execute("SELECT 1")
+
+                listen_conn.poll()
+                while listen_conn.notifies:
+                    n = listen_conn.notifies.pop(0)
+                    _cache_clear(CACHE_CHANNELS[n.channel])
+
+        except Exception as e:
+            print("ERROR:", e)
+            if listen_conn is not None:
+                listen_conn.close()
+            time.sleep(5)
+
+
 # =========================
 # 👤 USER MANAGEMENT
 # =========================
@@ -124,74 +426,76 @@ def remove_whitelist(user_id):
         conn.commit()
 
 
-def is_whitelisted(user_id):
-    with get_connection() as conn:
-        with conn.cursor() as c:
-            c.execute(
-                "SELECT whitelisted FROM users WHERE user_id=%s",
-                (user_id,)
-            )
-            r = c.fetchone()
-            return r and r[0]
+UserState = namedtuple(
+    "UserState",
+    "banned auto_banned shadow_banned whitelisted media_count username"
+)
+
+
+def get_user_state(user_id):
+    """
+    Fetch every per-user flag the relay needs in one round-trip.
+    Returns UserState or None if the user is not registered.
+    """
+    r = _fetchone("EXECUTE q_user_state(%s)", (user_id,))
+    return UserState(*r) if r else None
 
 def get_all_users():
     """
     Return all users who are allowed to receive broadcast.
     Excludes manually banned and auto-banned users.
+    Cached until a users_changed notification.
     """
-    with conn.cursor() as c:
-        c.execute("""
-            SELECT user_id
-            FROM users
-            WHERE banned=FALSE
-              AND auto_banned=FALSE
-        """)
-        return c.fetchall()
+    return _cached(_users_cache, lambda: _fetchall("""
+        SELECT user_id
+        FROM users
+        WHERE banned=FALSE
+          AND auto_banned=FALSE
+    """))
 
 
 def add_user(user_id):
     """Add user to database."""
-    with conn.cursor() as c:
-        c.execute(
-            "INSERT INTO users (user_id) VALUES (%s) ON CONFLICT DO NOTHING",
-            (user_id,)
-        )
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute(
+                "INSERT INTO users (user_id) VALUES (%s) ON CONFLICT DO NOTHING",
+                (user_id,)
+            )
         conn.commit()
-
-
-def user_exists(user_id):
-    """Check if user exists."""
-    with conn.cursor() as c:
-        c.execute("SELECT 1 FROM users WHERE user_id=%s", (user_id,))
-        return c.fetchone() is not None
-
-
-def get_username(user_id):
-    """Get stored username."""
-    with conn.cursor() as c:
-        c.execute("SELECT username FROM users WHERE user_id=%s", (user_id,))
-        r = c.fetchone()
-        return r[0] if r else None
+    _cache_clear(_users_cache)
 
 
 def set_username(user_id, username):
     """Set username."""
-    with conn.cursor() as c:
-        c.execute(
-            "UPDATE users SET username=%s WHERE user_id=%s",
-            (username.lower(), user_id)
-        )
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute(
+                "UPDATE users SET username=%s WHERE user_id=%s",
+                (username.lower(), user_id)
+            )
+            if user_id == ADMIN_ID:
+                c.execute("NOTIFY admin_changed")
         conn.commit()
 
+    if user_id == ADMIN_ID:
+        _cache_clear(_admin_cache)
+
+
+def get_admin_username():
+    """Admin's username, cached so admin relays skip the DB."""
+    def load():
+        state = get_user_state(ADMIN_ID)
+        return (state.username if state else None,)
+    return _cached(_admin_cache, load)[0]
+
 
 def username_taken(username):
     """Check if username already taken."""
-    with conn.cursor() as c:
-        c.execute(
-            "SELECT 1 FROM users WHERE username=%s",
-            (username.lower(),)
-        )
-        return c.fetchone() is not None
+    return _fetchone(
+        "EXECUTE q_username_taken(%s)",
+        (username.lower(),)
+    ) is not None
 
 
 # =========================
@@ -200,40 +504,31 @@ def username_taken(username):
 
 def ban_user(user_id):
     """Manual ban."""
-    with conn.cursor() as c:
-        c.execute(
-            "UPDATE users SET banned=TRUE WHERE user_id=%s",
-            (user_id,)
-        )
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute(
+                "UPDATE users SET banned=TRUE WHERE user_id=%s",
+                (user_id,)
+            )
         conn.commit()
+    _cache_clear(_users_cache)
 
 
 def unban_user(user_id):
     """Manual unban."""
-    with conn.cursor() as c:
-        c.execute(
-            "UPDATE users SET banned=FALSE WHERE user_id=%s",
-            (user_id,)
-        )
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute(
+                "UPDATE users SET banned=FALSE WHERE user_id=%s",
+                (user_id,)
+            )
         conn.commit()
-
-
-def is_banned(user_id):
-    """Check manual ban."""
-    with conn.cursor() as c:
-        c.execute(
-            "SELECT banned FROM users WHERE user_id=%s",
-            (user_id,)
-        )
-        r = c.fetchone()
-        return r and r[0]
+    _cache_clear(_users_cache)
 
 
 def get_banned_users():
     """Return list of manually banned users."""
-    with conn.cursor() as c:
-        c.execute("SELECT user_id FROM users WHERE banned=TRUE")
-        return c.fetchall()
+    return _fetchall("SELECT user_id FROM users WHERE banned=TRUE")
 
 
 # =========================
@@ -242,26 +537,16 @@ def get_banned_users():
 
 def shadow_toggle(user_id):
     """Toggle shadow ban."""
-    with conn.cursor() as c:
-        c.execute("""
-            UPDATE users
-            SET shadow_banned = NOT shadow_banned
-            WHERE user_id=%s
-        """, (user_id,))
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                UPDATE users
+                SET shadow_banned = NOT shadow_banned
+                WHERE user_id=%s
+            """, (user_id,))
         conn.commit()
 
 
-def is_shadow(user_id):
-    """Check if shadow banned."""
-    with conn.cursor() as c:
-        c.execute(
-            "SELECT shadow_banned FROM users WHERE user_id=%s",
-            (user_id,)
-        )
-        r = c.fetchone()
-        return r and r[0]
-
-
 # =========================
 # ⏳ AUTO INACTIVITY SYSTEM
 # =========================
@@ -271,44 +556,25 @@ def update_media_activity(user_id, amount=1):
 
     with get_connection() as conn:
         with conn.cursor() as c:
+            c.execute(
+                "EXECUTE q_media_activity(%s, %s, %s)",
+                (now, amount, user_id)
+            )
+            was_auto_banned, count = c.fetchone()
 
-            c.execute("""
-                UPDATE users
-                SET last_media=%s,
-                    media_count = media_count + %s
-                WHERE user_id=%s
-            """, (now, amount, user_id))
-
-            c.execute("""
-                SELECT auto_banned, media_count
-                FROM users
-                WHERE user_id=%s
-            """, (user_id,))
-            auto_banned, count = c.fetchone()
-
-            # 🔹 Initial activation
-            if count < 12:
-                remaining = 12 - count
-                conn.commit()
-                return "progress", remaining
-
-            # 🔹 If auto-banned and reached 12 → recover
-            if auto_banned and count >= 12:
-                c.execute("""
-                    UPDATE users
-                    SET auto_banned=FALSE,
-                        media_count=12
-                    WHERE user_id=%s
-                """, (user_id,))
-                conn.commit()
-                return "reactivated", 0
+    # 🔹 Initial activation
+    if count < 12:
+        return "progress", 12 - count
 
-        conn.commit()
+    # 🔹 If auto-banned and reached 12 → recovered in the same UPDATE
+    if was_auto_banned:
+        _cache_clear(_users_cache)
+        return "reactivated", 0
 
     return "active", 0
 
 def check_inactive_users():
-    limit = int(time.time()) - 60*5
+    limit = int(time.time()) - INACTIVE_AFTER
 
     with get_connection() as conn:
         with conn.cursor() as c:
@@ -318,22 +584,26 @@ def check_inactive_users():
                 WHERE (last_media IS NULL OR last_media < %s)
                   AND banned=FALSE
                   AND whitelisted=FALSE
+                  AND auto_banned=FALSE
                   AND user_id != %s
             """, (limit, ADMIN_ID))
+            changed = c.rowcount
 
         conn.commit()
 
+    if changed:
+        _cache_clear(_users_cache)
 
 
-def is_auto_banned(user_id):
-    """Check auto ban."""
-    with conn.cursor() as c:
-        c.execute(
-            "SELECT auto_banned FROM users WHERE user_id=%s",
-            (user_id,)
-        )
-        r = c.fetchone()
-        return r and r[0]
+
+def inactivity_worker():
+    """Periodically auto-ban inactive users, off the message path."""
+    while True:
+        time.sleep(INACTIVITY_CHECK_INTERVAL)
+        try:
+            check_inactive_users()
+        except Exception as e:
+            print("ERROR:", e)
 
 
 # =========================
@@ -342,19 +612,18 @@ def is_auto_banned(user_id):
 
 def is_join_open():
     """Check if joining allowed."""
-    with conn.cursor() as c:
-        c.execute("SELECT value FROM settings WHERE key='join_open'")
-        r = c.fetchone()
-        return r and r[0] == "true"
+    r = _fetchone("SELECT value FROM settings WHERE key='join_open'")
+    return r and r[0] == "true"
 
 
 def set_join_status(status: bool):
     """Set join open/close."""
-    with conn.cursor() as c:
-        c.execute(
-            "UPDATE settings SET value=%s WHERE key='join_open'",
-            ("true" if status else "false",)
-        )
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute(
+                "UPDATE settings SET value=%s WHERE key='join_open'",
+                ("true" if status else "false",)
+            )
         conn.commit()
 
 
@@ -362,148 +631,167 @@ def set_join_status(status: bool):
 # 📊 STATS HELPERS
 # =========================
 
-def get_total_users():
-    with conn.cursor() as c:
-        c.execute("SELECT COUNT(*) FROM users")
-        return c.fetchone()[0]
+def get_all_stats():
+    """
+    Return (total, manual_banned, auto_banned, shadow_banned)
+    counted in a single scan.
+    """
+    return _fetchone("""
+        SELECT COUNT(*),
+               COUNT(*) FILTER (WHERE banned),
+               COUNT(*) FILTER (WHERE auto_banned),
+               COUNT(*) FILTER (WHERE shadow_banned)
+        FROM users
+    """)
 
 
-def get_manual_banned_count():
-    with conn.cursor() as c:
-        c.execute("SELECT COUNT(*) FROM users WHERE banned=TRUE")
-        return c.fetchone()[0]
+# =========================
+# 🚫 BANNED WORD SYSTEM
+# =========================
+# (words, match) swapped as one tuple so handler threads never
+# pair a new word set with a stale matcher.
+_matcher = (None, None)
 
 
-def get_auto_banned_count():
-    with conn.cursor() as c:
-        c.execute("SELECT COUNT(*) FROM users WHERE auto_banned=TRUE")
-        return c.fetchone()[0]
+def _build_matcher(words):
+    """
+    Return match(text) -> bool over all words in one pass:
+    an Aho-Corasick automaton when pyahocorasick is installed,
+    otherwise a single case-insensitive compiled regex alternation.
+    """
+    if not words:
+        return None
 
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for word in words:
+            automaton.add_word(word, word)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text.lower()), None) is not None
 
-def get_shadow_banned_count():
-    with conn.cursor() as c:
-        c.execute("SELECT COUNT(*) FROM users WHERE shadow_banned=TRUE")
-        return c.fetchone()[0]
+    # Longest first so overlapping alternatives prefer the longer word
+    # IGNORECASE lets the C engine fold case instead of copying text
+    pattern = re.compile("|".join(
+        map(re.escape, sorted(words, key=len, reverse=True))
+    ), re.IGNORECASE)
+    return lambda text: pattern.search(text) is not None
 
 
-# =========================
-# 🚫 BANNED WORD SYSTEM
-# =========================
 def contains_banned_word(text):
-    words = get_banned_words()
+    global _matcher
 
-    text_lower = text.lower()
+    words = get_banned_words()
+    built_for, match = _matcher
 
-    for word in words:
-        if word in text_lower:
-            return True
+    # Rebuilt lazily, only when the cached word set changes
+    if built_for is not words:
+        match = _build_matcher(words)
+        _matcher = (words, match)
 
-    return False
+    return match is not None and match(text)
 
 
 def add_banned_word(word):
-    with conn.cursor() as c:
-        c.execute(
-            "INSERT INTO banned_words (word) VALUES (%s) ON CONFLICT DO NOTHING",
-            (word.lower(),)
-        )
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute(
+                "INSERT INTO banned_words (word) VALUES (%s) ON CONFLICT DO NOTHING",
+                (word.lower(),)
+            )
+            c.execute("NOTIFY banned_words_changed")
         conn.commit()
+    _cache_clear(_words_cache)
 
 
 def remove_banned_word(word):
-    with conn.cursor() as c:
-        c.execute(
-            "DELETE FROM banned_words WHERE word=%s",
-            (word.lower(),)
-        )
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute(
+                "DELETE FROM banned_words WHERE word=%s",
+                (word.lower(),)
+            )
+            c.execute("NOTIFY banned_words_changed")
         conn.commit()
+    _cache_clear(_words_cache)
 
 
 def get_banned_words():
-    with conn.cursor() as c:
-        c.execute("SELECT word FROM banned_words")
-        return [r[0] for r in c.fetchall()]
+    """Return the banned words (stored lowercase) as a frozenset."""
+    return _cached(_words_cache, lambda: frozenset(
+        r[0] for r in _fetchall("SELECT word FROM banned_words")
+    ))
 
 
 # =========================
 # 📩 MESSAGE TRACKING
 # =========================
 
-def save_message_map(bot_msg_id, original_user_id, receiver_id):
-    """Store broadcasted message mapping."""
-    with conn.cursor() as c:
-        c.execute("""
-            INSERT INTO message_map
-            (bot_message_id, original_user_id, receiver_id)
-            VALUES (%s,%s,%s)
-            ON CONFLICT DO NOTHING
-        """, (bot_msg_id, original_user_id, receiver_id))
-        conn.commit()
+def save_message_map(rows):
+    """
+    Queue broadcasted message mappings for message_map_writer.
+    rows: list of (bot_message_id, original_user_id, receiver_id)
+    """
+    for row in rows:
+        message_map_queue.put(row)
 
 
-def get_original_user(bot_msg_id):
-    with conn.cursor() as c:
-        c.execute("""
-            SELECT original_user_id FROM message_map
-            WHERE bot_message_id=%s
-        """, (bot_msg_id,))
-        r = c.fetchone()
-        return r[0] if r else None
+def message_map_writer():
+    """Write queued mappings in batches, off the send path."""
+    while True:
+        batch = [message_map_queue.get()]
+        deadline = time.monotonic() + MAP_FLUSH_INTERVAL
+
+        # Flush at MAP_FLUSH_ROWS or MAP_FLUSH_INTERVAL, whichever first
+        while len(batch) < MAP_FLUSH_ROWS:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(message_map_queue.get(timeout=timeout))
+            except Empty:
+                break
 
+        _write_message_map(batch)
 
-def get_user_messages(user_id):
-    """Get all broadcasted messages of a user."""
-    with conn.cursor() as c:
-        c.execute("""
-            SELECT bot_message_id, receiver_id
-            FROM message_map
-            WHERE original_user_id=%s
-        """, (user_id,))
-        return c.fetchall()
-def user_blocked_by_system(user_id):
+
+def _write_message_map(batch):
     """
-    Returns (blocked: bool, reason_message: str or None)
-    Used before broadcasting.
+    Insert one batch, retrying with backoff so a short DB outage
+    doesn't lose the rows /del and /purge depend on.
     """
-
-    # 🚫 Manual ban
-    if is_banned(user_id):
-        bot.reply_to(message, "🚫 You are banned.")
-        return
-    
-    # ⏳ Auto-ban recovery logic
-    if is_auto_banned(user_id):
-    
-        if message.content_type in ['photo', 'video']:
-    
-            reactivated = update_media_activity(user_id)
-    
-            if reactivated:
-                bot.reply_to(message, "🎉 You are active again! Stay active.")
-    
-            else:
-                # Show progress
-                with get_connection() as conn:
-                    with conn.cursor() as c:
-                        c.execute(
-                            "SELECT media_count FROM users WHERE user_id=%s",
-                            (user_id,)
-                        )
-                        count = c.fetchone()[0]
-    
-                bot.reply_to(
-                    message,
-                    f"📸 Progress: {count}/12 media required to reactivate."
-                )
-    
+    delay = 1
+    for attempt in range(MAP_FLUSH_RETRIES):
+        try:
+            with get_connection() as conn:
+                with conn.cursor() as c:
+                    execute_values(c, """
+                        INSERT INTO message_map
+                        (bot_message_id, original_user_id, receiver_id)
+                        VALUES %s
+                        ON CONFLICT DO NOTHING
+                    """, batch, page_size=MAP_FLUSH_ROWS)
             return
-    
-        else:
-            bot.reply_to(
-                message,
-                "⏳ You are inactive.\nSend 12 media to reactivate."
-            )
-            return False, None
+        except Exception as e:
+            print("ERROR:", e)
+            if attempt + 1 < MAP_FLUSH_RETRIES:
+                time.sleep(delay)
+                delay *= 2
+
+    print("ERROR: dropped", len(batch), "message_map rows")
+
+
+def get_original_user(bot_msg_id):
+    r = _fetchone("EXECUTE q_original_user(%s)", (bot_msg_id,))
+    return r[0] if r else None
+
+
+def get_user_messages(user_id):
+    """Get all broadcasted messages of a user."""
+    return _fetchall("""
+        SELECT bot_message_id, receiver_id
+        FROM message_map
+        WHERE original_user_id=%s
+    """, (user_id,))
 
 # =========================================================
 # 👤 USER FLOW
@@ -512,30 +800,33 @@ def user_blocked_by_system(user_id):
 @bot.message_handler(commands=['start'])
 def start(message):
     user_id = message.chat.id
+    state = get_user_state(user_id)
     # 👑 ADMIN BYPASS (no activation needed)
     if user_id == ADMIN_ID:
-        if not user_exists(user_id):
+        if state is None:
             add_user(user_id)
 
         now = int(time.time())
-        with conn.cursor() as c:
-            c.execute(
-                "UPDATE users SET last_media=%s, media_count=12, auto_banned=FALSE WHERE user_id=%s",
-                (now, user_id)
-            )
+        with get_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(
+                    "UPDATE users SET last_media=%s, media_count=12, auto_banned=FALSE WHERE user_id=%s",
+                    (now, user_id)
+                )
             conn.commit()
+        _cache_clear(_users_cache)
 
         bot.reply_to(message, "👑 Admin access granted.")
         return
 
 
     # 🚫 Manual ban check
-    if is_banned(user_id):
+    if state and state.banned:
         bot.reply_to(message, "🚫 You are banned.")
         return
 
     # 🆕 New user
-    if not user_exists(user_id):
+    if state is None:
 
         if not is_join_open():
             bot.reply_to(message, "Maximun number of users reached. joining is currently closed.")
@@ -546,27 +837,35 @@ def start(message):
 
         # Set initial activity timestamp
         now = int(time.time())
-        with conn.cursor() as c:
-            c.execute(
-                "UPDATE users SET last_media=%s WHERE user_id=%s",
-                (now, user_id)
-            )
+        with get_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(
+                    "UPDATE users SET last_media=%s WHERE user_id=%s",
+                    (now, user_id)
+                )
             conn.commit()
 
-        waiting_username.add(user_id)
+        with state_lock:
+            waiting_username[user_id] = True
         bot.reply_to(message, "👋 Welcome! Send your username.")
         return
 
     # 📝 Existing user but no username
-    if not get_username(user_id):
-        waiting_username.add(user_id)
+    if not state.username:
+        with state_lock:
+            waiting_username[user_id] = True
         bot.reply_to(message, "✍ Send your username.")
         return
 
     # ✅ Normal case
     bot.reply_to(message, "👋 Welcome back!")
 
-@bot.message_handler(func=lambda m: m.chat.id in waiting_username,content_types=['text'])
+def is_waiting_username(user_id):
+    with state_lock:
+        return user_id in waiting_username
+
+
+@bot.message_handler(func=lambda m: is_waiting_username(m.chat.id),content_types=['text'])
 def receive_username(message):
     uid=message.chat.id
     name=message.text.strip().lower()
@@ -577,7 +876,8 @@ def receive_username(message):
         bot.reply_to(message,"❌ Username already taken.")
         return
     set_username(uid,name)
-    waiting_username.discard(uid)
+    with state_lock:
+        waiting_username.pop(uid, None)
     bot.reply_to(message,f"✅ Username set to @{name}")
     bot.reply_to(
         message,
@@ -590,80 +890,146 @@ def receive_username(message):
 # =========================================================
 # 📡 RELAY
 # =========================================================
-def broadcast_worker():
-    while True:
-        job = broadcast_queue.get()
+class RateLimiter:
+    """
+    Token bucket shared by all sending threads.
+    Spaces calls to `rate` per second globally and
+    `per_chat` per second for any single chat.
+    """
+
+    def __init__(self, rate, per_chat):
+        self.interval = 1.0 / rate
+        self.chat_interval = 1.0 / per_chat
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+        self.chat_slots = {}
+
+    def acquire(self, chat_id=None):
+        with self.lock:
+            slot = max(time.monotonic(), self.next_slot)
+            self.next_slot = slot + self.interval
+
+            if chat_id is not None:
+                slot = max(slot, self.chat_slots.get(chat_id, 0.0))
+                self.chat_slots[chat_id] = slot + self.chat_interval
+
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
 
-        if job["type"] == "single":
-            _process_single(job["message"])
+send_limiter = RateLimiter(rate=SEND_RATE, per_chat=SEND_RATE_PER_CHAT)
 
-        elif job["type"] == "album":
-            _process_album(job["messages"])
+# telebot keeps one requests.Session per thread, so each worker
+# reuses its own keep-alive connection to api.telegram.org.
+send_executor = ThreadPoolExecutor(max_workers=SEND_WORKERS)
 
-        broadcast_queue.task_done()
-def build_prefix(user_id):
-    username = get_username(user_id)
+# Independent broadcasts progress in parallel; a slow album
+# no longer holds up the messages queued behind it.
+broadcast_pool = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS)
 
+# Activation/recovery album replies are one DB call and one send;
+# they must not queue behind fan-outs holding broadcast_pool.
+callback_pool = ThreadPoolExecutor(max_workers=CALLBACK_WORKERS)
+
+
+def _submit(executor, fn, *args):
+    def run():
+        try:
+            fn(*args)
+        except Exception as e:
+            print("ERROR:", e)
+
+    executor.submit(run)
+
+
+def submit_broadcast(fn, *args):
+    _submit(broadcast_pool, fn, *args)
+
+
+def build_prefix(username):
     if username:
         return f" #{username}:\n"
     else:
         return "👤 Unknown:\n"
-def _process_single(message):
-
-    users = get_all_users()
-    prefix = build_prefix(message.chat.id)
+def _send_single(uid, message, prefix):
+    """Send one relayed message to uid and queue its mapping."""
+    try:
+        send_limiter.acquire(uid)
 
-    for (uid,) in users:
+        # TEXT MESSAGE
+        if message.content_type == "text":
+            sent = bot.send_message(
+                uid,
+                prefix + message.text
+            )
 
-        if uid == message.chat.id:
-            continue
+        # PHOTO
+        elif message.content_type == "photo":
+            caption = message.caption or ""
+            sent = bot.send_photo(
+                uid,
+                message.photo[-1].file_id,
+                caption=prefix + caption
+            )
 
-        try:
+        # VIDEO
+        elif message.content_type == "video":
+            caption = message.caption or ""
+            sent = bot.send_video(
+                uid,
+                message.video.file_id,
+                caption=prefix + caption
+            )
 
-            # TEXT MESSAGE
-            if message.content_type == "text":
-                sent = bot.send_message(
-                    uid,
-                    prefix + message.text
-                )
+        else:
+            return
 
-            # PHOTO
-            elif message.content_type == "photo":
-                caption = message.caption or ""
-                sent = bot.send_photo(
-                    uid,
-                    message.photo[-1].file_id,
-                    caption=prefix + caption
-                )
+        # Queued per send so /ban, /del etc. work before the fan-out ends
+        save_message_map([(sent.message_id, message.chat.id, uid)])
 
-            # VIDEO
-            elif message.content_type == "video":
-                caption = message.caption or ""
-                sent = bot.send_video(
-                    uid,
-                    message.video.file_id,
-                    caption=prefix + caption
-                )
+    except Exception as e:
+        print("ERROR:", e)
 
-            else:
-                continue
 
-            # Save message mapping
-            save_message_map(
-                sent.message_id,
-                message.chat.id,
-                uid
-            )
+def _send_album(uid, chunks, source_id):
+    """Send every album chunk to uid, queueing each chunk's mappings."""
+    for chunk in chunks:
+        try:
+            send_limiter.acquire(uid)
+            sent_msgs = bot.send_media_group(uid, chunk)
 
-            time.sleep(0.04)
+            save_message_map([
+                (sm.message_id, source_id, uid) for sm in sent_msgs
+            ])
 
         except Exception as e:
             print("ERROR:", e)
 
-def _process_album(messages):
+
+def _process_single(message, username):
+
+    if message.content_type not in ("text", "photo", "video"):
+        return
+
+    users = get_all_users()
+    prefix = build_prefix(username)
+
+    futures = [
+        send_executor.submit(_send_single, uid, message, prefix)
+        for (uid,) in users
+        if uid != message.chat.id
+    ]
+
+    # Hold the broadcast slot until the fan-out is done
+    for f in futures:
+        f.result()
+
+def _process_album(messages, username):
 
     users = get_all_users()
-    prefix = build_prefix(messages[0].chat.id)
+    prefix = build_prefix(username)
+    source_id = messages[0].chat.id
 
     media_batch = []
 
@@ -691,31 +1057,88 @@ def _process_album(messages):
                 )
             )
 
+    if not media_batch:
+        return
+
+    # Built once, shared read-only by every recipient's send task
     chunks = [media_batch[i:i+10] for i in range(0, len(media_batch), 10)]
 
-    for (uid,) in users:
+    futures = [
+        send_executor.submit(_send_album, uid, chunks, source_id)
+        for (uid,) in users
+        if uid != source_id
+    ]
 
-        if uid == messages[0].chat.id:
-            continue
+    for f in futures:
+        f.result()
 
-        for chunk in chunks:
-            try:
-                sent_msgs = bot.send_media_group(uid, chunk)
 
-                for sm in sent_msgs:
-                    save_message_map(
-                        sm.message_id,
-                        messages[0].chat.id,
-                        uid
-                    )
+def _collect_album(message, on_complete, executor=broadcast_pool):
+    """
+    Buffer one part of a media group. The first part schedules a
+    flush that runs on_complete with the whole album on executor
+    once the rest of the parts have had time to arrive.
+    """
+    group_id = message.media_group_id
 
-                time.sleep(0.04)
+    with album_cond:
+        media_groups.setdefault(group_id, []).append(message)
+
+        if group_id in album_timers:
+            return
+
+        deadline = time.monotonic() + ALBUM_WAIT
+        album_timers[group_id] = deadline
+        heapq.heappush(
+            album_heap, (deadline, group_id, executor, on_complete)
+        )
+        album_cond.notify()
+
+
+def album_flusher():
+    """Fire due album flushes from one thread instead of one per album."""
+    while True:
+        with album_cond:
+            while not album_heap or album_heap[0][0] > time.monotonic():
+                timeout = None
+                if album_heap:
+                    timeout = album_heap[0][0] - time.monotonic()
+                album_cond.wait(timeout)
+
+            _, group_id, executor, on_complete = heapq.heappop(album_heap)
+            album = media_groups.pop(group_id, [])
+            album_timers.pop(group_id, None)
+
+        if album:
+            # Handler threads append parts in arrival order, not send order
+            album.sort(key=lambda m: m.message_id)
+            _submit(executor, on_complete, album)
+
+
+def notify_progress(user_id, remaining, text):
+    """
+    Send an activation progress message only on the first media,
+    every PROGRESS_STEP media after that, or after a jump of at
+    least PROGRESS_STEP (albums), instead of once per media.
+    """
+    with state_lock:
+        last = progress_notified.get(user_id)
+
+        if (last is not None
+                and remaining % PROGRESS_STEP != 0
+                and last - remaining < PROGRESS_STEP):
+            return
+
+        progress_notified[user_id] = remaining
+
+    bot.send_message(user_id, text)
 
-            except Exception as e:
-                print("ERROR:", e)
+
+def forget_progress(user_id):
+    with state_lock:
+        progress_notified.pop(user_id, None)
 
 
-#@bot.message_handler(content_types=['text', 'photo', 'video'])
 @bot.message_handler(
     func=lambda m: not m.text or not m.text.startswith('/'),
     content_types=['text','photo','video']
@@ -723,120 +1146,99 @@ def _process_album(messages):
 def relay(message):
 
     user_id = message.chat.id
+
+    # 👑 ADMIN BYPASS (skip all restrictions and all DB work)
+    if is_admin(user_id):
+        _broadcast(message, get_admin_username())
+        return
+
     count = 0
     auto_banned = False
+    state = get_user_state(user_id)
+    username = state.username if state else None
+
     # 🚫 Manual ban
-    if is_banned(user_id):
+    if state and state.banned:
         bot.send_message(user_id, "🚫 You are banned.")
         return
 
-    # 👑 ADMIN BYPASS (skip all restrictions)
-    if user_id == ADMIN_ID:
-        pass
-    else:
-        # 🔒 Only apply restrictions to normal users
-        if not is_whitelisted(user_id):
+    # 🔒 Only apply restrictions to normal users
+    if not (state and state.whitelisted):
 
-            with get_connection() as conn:
-                with conn.cursor() as c:
-                    c.execute(
-                        "SELECT media_count, auto_banned FROM users WHERE user_id=%s",
-                        (user_id,)
-                    )
-                    row = c.fetchone()
-
-            if row:
-                count, auto_banned = row
-            else:
-                bot.send_messaage(
-                    user_id,
-                    "Plesase send /start "
-                )
-                return
-                
-            # =========================
-            # 🔒 INITIAL ACTIVATION
-            # =========================
-            if count < 12 and not auto_banned:
-
-                # Album case
-                if message.media_group_id:
-
-                    group_id = message.media_group_id
-                    media_groups[group_id].append(message)
-
-                    if group_id in album_timers:
-                        return
-
-                    def process_activation():
-                        time.sleep(0.8)
-
-                        album = media_groups.pop(group_id, [])
-                        album_timers.pop(group_id, None)
-
-                        if not album:
-                            return
-
-                        status, remaining = update_media_activity(
-                            user_id,
-                            len(album)
-                        )
-
-                        if remaining > 0:
-                            bot.send_message(
-                                user_id,
-                                f"📸 {remaining} media left to activate."
-                            )
-                        else:
-                            bot.send_message(
-                                user_id,
-                                "🎉 Your account is now activated!"
-                            )
-
-                    album_timers[group_id] = True
-                    threading.Thread(target=process_activation).start()
-                    return
+        if state:
+            count, auto_banned = state.media_count, state.auto_banned
+        else:
+            bot.send_message(
+                user_id,
+                "Plesase send /start "
+            )
+            return
+            
+        # =========================
+        # 🔒 INITIAL ACTIVATION
+        # =========================
+        if count < 12 and not auto_banned:
 
-                # Single media
-                elif message.content_type in ['photo', 'video']:
+            # Album case
+            if message.media_group_id:
 
-                    status, remaining = update_media_activity(user_id, 1)
+                def process_activation(album):
+                    status, remaining = update_media_activity(
+                        user_id,
+                        len(album)
+                    )
 
                     if remaining > 0:
-                        bot.send_message(
+                        notify_progress(
                             user_id,
+                            remaining,
                             f"📸 {remaining} media left to activate."
                         )
                     else:
+                        forget_progress(user_id)
                         bot.send_message(
                             user_id,
                             "🎉 Your account is now activated!"
                         )
 
-                    return
+                _collect_album(message, process_activation, callback_pool)
+                return
 
-                # Text
+            # Single media
+            elif message.content_type in ['photo', 'video']:
+
+                status, remaining = update_media_activity(user_id, 1)
+
+                if remaining > 0:
+                    notify_progress(
+                        user_id,
+                        remaining,
+                        f"📸 {remaining} media left to activate."
+                    )
                 else:
+                    forget_progress(user_id)
                     bot.send_message(
                         user_id,
-                        "🔒 Send 12 media to activate your account."
+                        "🎉 Your account is now activated!"
                     )
-                    return
 
-    # =========================
-    # ✅ NORMAL BROADCAST SECTION
-    # =========================
+                return
 
-    # (Your album broadcast logic here)
-    # (Your queue logic here)
+            # Text
+            else:
+                bot.send_message(
+                    user_id,
+                    "🔒 Send 12 media to activate your account."
+                )
+                return
 
-        # Text case
-        else:
-            bot.send_message(
-                user_id,
-                "🔒 Send 12 media to activate your account."
-            )
-            return
+    # Text case
+    else:
+        bot.send_message(
+            user_id,
+            "🔒 Send 12 media to activate your account."
+        )
+        return
 
     # =========================
     # ⏳ AUTO-BAN RECOVERY
@@ -846,39 +1248,26 @@ def relay(message):
         # Album case
         if message.media_group_id:
 
-            group_id = message.media_group_id
-            media_groups[group_id].append(message)
-
-            if group_id in album_timers:
-                return
-
-            def process_recovery():
-                time.sleep(0.8)
-
-                album = media_groups.pop(group_id, [])
-                album_timers.pop(group_id, None)
-
-                if not album:
-                    return
-
+            def process_recovery(album):
                 status, remaining = update_media_activity(
                     user_id,
                     len(album)
                 )
 
                 if status == "reactivated":
+                    forget_progress(user_id)
                     bot.send_message(
                         user_id,
                         "🎉 You are active again!"
                     )
                 elif remaining > 0:
-                    bot.send_message(
+                    notify_progress(
                         user_id,
+                        remaining,
                         f"📸 {remaining} media left to reactivate."
                     )
 
-            album_timers[group_id] = True
-            threading.Thread(target=process_recovery).start()
+            _collect_album(message, process_recovery, callback_pool)
             return
 
         # Single media
@@ -887,13 +1276,15 @@ def relay(message):
             status, remaining = update_media_activity(user_id, 1)
 
             if status == "reactivated":
+                forget_progress(user_id)
                 bot.send_message(
                     user_id,
                     "🎉 You are active again!"
                 )
             elif remaining > 0:
-                bot.send_message(
+                notify_progress(
                     user_id,
+                    remaining,
                     f"📸 {remaining} media left to reactivate."
                 )
 
@@ -909,7 +1300,7 @@ def relay(message):
     
     
     # 👻 Shadow behavior
-    if is_shadow(user_id):
+    if state and state.shadow_banned:
         bot.reply_to(message, "✅ Message sent.")
         return
 
@@ -919,48 +1310,29 @@ def relay(message):
             bot.reply_to(message, " Message contains banned word.")
             return
 
-    # ⏳ Inactivity check
-    check_inactive_users()
-
     # Media tracking
     if message.content_type in ['photo', 'video']:
         update_media_activity(user_id)
 
-    # =========================
+    _broadcast(message, username)
+
+
+# =========================
+# ✅ NORMAL BROADCAST SECTION
+# =========================
+def _broadcast(message, username):
+    """Queue a message (or its whole album) for every user."""
+
     # 📦 Album Handling
-    # =========================
-        if message.media_group_id:
-    
-            group_id = message.media_group_id
-            media_groups[group_id].append(message)
-    
-        # If timer already started, just return
-        if group_id in album_timers:
-            return
-    
-        # Start delayed processor
-        def process_album():
-            time.sleep(0.8)  # allow all parts to arrive
-    
-            album = media_groups.pop(group_id, [])
-            album_timers.pop(group_id, None)
-    
-            if album:
-                broadcast_queue.put({
-                    "type": "album",
-                    "messages": album
-                })
-    
-        album_timers[group_id] = True
-        threading.Thread(target=process_album).start()
-    
+    if message.media_group_id:
+
+        def process_album(album):
+            _process_album(album, username)
+
+        _collect_album(message, process_album)
         return  # IMPORTANT: stop here for album messages
 
-    else:
-        broadcast_queue.put({
-            "type": "single",
-            "message": message
-        })
+    submit_broadcast(_process_single, message, username)
 
 # =========================================================
 # 🛠 ADMIN COMMANDS
@@ -973,10 +1345,7 @@ def stats(message):
     if not is_admin(message.chat.id):
         return
 
-    total = get_total_users()
-    banned = get_manual_banned_count()
-    auto = get_auto_banned_count()
-    shadow = get_shadow_banned_count()
+    total, banned, auto, shadow = get_all_stats()
 
     bot.reply_to(
         message,
@@ -1013,13 +1382,14 @@ def info(message):
         bot.reply_to(message, "❌ Use:\n/info USER_ID\nor reply to a user message.")
         return
 
-    with conn.cursor() as c:
-        c.execute("""
-            SELECT user_id, username, banned,
-                   auto_banned, shadow_banned, media_count
-            FROM users WHERE user_id=%s
-        """, (uid,))
-        data = c.fetchone()
+    with get_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT user_id, username, banned,
+                       auto_banned, shadow_banned, media_count
+                FROM users WHERE user_id=%s
+            """, (uid,))
+            data = c.fetchone()
 
     if not data:
         bot.reply_to(message, "❌ User not found.")
@@ -1082,6 +1452,37 @@ def admin_unban(message):
     unban_user(uid)
     bot.reply_to(message, f"✅ User {uid} unbanned.")
 
+def _delete_chunk(chat_id, ids):
+    # Telegram refusals and network errors count as "0 deleted" so one
+    # chat can't abort the command; anything else (e.g. a telebot
+    # without delete_messages) propagates to it
+    send_limiter.acquire(chat_id)
+    try:
+        bot.delete_messages(chat_id, ids)
+        return len(ids)
+    except (telebot.apihelper.ApiException, RequestException) as e:
+        print("ERROR:", e)
+        return 0
+
+
+def delete_mapped_messages(rows):
+    """
+    Delete (bot_message_id, receiver_id) rows with deleteMessages,
+    up to 100 ids per call, chats in parallel. Returns count deleted.
+    """
+    by_chat = defaultdict(list)
+    for mid, receiver_id in rows:
+        by_chat[receiver_id].append(mid)
+
+    futures = [
+        send_executor.submit(_delete_chunk, chat_id, ids[i:i+100])
+        for chat_id, ids in by_chat.items()
+        for i in range(0, len(ids), 100)
+    ]
+
+    return sum(f.result() for f in futures)
+
+
 @bot.message_handler(commands=['purge'])
 def purge_user(message):
     if not is_admin(message.chat.id):
@@ -1099,15 +1500,7 @@ def purge_user(message):
 
     rows = get_user_messages(uid)
 
-    deleted = 0
-
-    for mid, receiver_id in rows:
-        try:
-            bot.delete_message(receiver_id, mid)
-            deleted += 1
-        except Exception as e:
-            print("ERROR:", e)
-
+    deleted = delete_mapped_messages(rows)
 
     bot.reply_to(message, f"🧹 Purged {deleted} messages.")
 @bot.message_handler(commands=['del'])
@@ -1127,15 +1520,7 @@ def delete_everywhere(message):
 
     rows = get_user_messages(original_uid)
 
-    deleted = 0
-
-    for mid, receiver_id in rows:
-        try:
-            bot.delete_message(receiver_id, mid)
-            deleted += 1
-        except Exception as e:
-            print("ERROR:", e)
-
+    deleted = delete_mapped_messages(rows)
 
     bot.reply_to(message, f"🗑 Deleted from {deleted} chats.")
 @bot.message_handler(commands=['addword'])
@@ -1174,7 +1559,7 @@ def list_words(message):
         return
 
     text = "🚫 BANNED WORDS:\n\n"
-    for w in words:
+    for w in sorted(words):
         text += f"• {w}\n"
 
     bot.reply_to(message, text)
@@ -1246,14 +1631,60 @@ def callback_handler(call):
         bot.send_message(call.message.chat.id, "🔒 Joining closed.")
 
 
-threading.Thread(target=broadcast_worker, daemon=True).start()
+threading.Thread(target=inactivity_worker, daemon=True).start()
+threading.Thread(target=album_flusher, daemon=True).start()
+threading.Thread(target=cache_listener, daemon=True).start()
+threading.Thread(target=message_map_writer, daemon=True).start()
 
 # =========================================================
 # ▶ START BOT
 # =========================================================
 
+app = Flask(__name__)
+
+
+# Served at WEBHOOK_URL's own path; give it a random one, not "/"
+@app.route(urlparse(WEBHOOK_URL or "").path or "/", methods=["POST"])
+def webhook():
+    # bytes: compare_digest rejects non-ASCII str with TypeError (500)
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return "", 403
+
+    update = telebot.types.Update.de_json(request.get_data().decode("utf-8"))
+    bot.process_new_updates([update])
+    return ""
+
+
 print("Bot is starting...")
-bot.infinity_polling(skip_pending=True)
+
+if WEBHOOK_URL:
+    # Push mode: Telegram POSTs updates to WEBHOOK_URL.
+    # `python gog.py` registers the webhook and serves it. Under
+    # gunicorn, register once, out of band, with
+    # `python gog.py set-webhook`, then serve exactly one worker:
+    #
+    #     gunicorn -w 1 --threads 8 gog:app
+    #
+    # Pending usernames, album buffers and send_limiter live in this
+    # process, so a second worker would split signups and albums and
+    # double the send rate. --preload is unsupported: the threads above
+    # and telebot's handler pool don't survive the fork.
+    if __name__ == "__main__":
+        # Replaces any existing webhook; no remove_webhook() gap
+        bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True,
+            max_connections=HANDLER_THREADS  # the one process's handlers
+        )
+
+        if sys.argv[1:] != ["set-webhook"]:
+            app.run(host="0.0.0.0", port=PORT)
+else:
+    # getUpdates is refused while a webhook is registered
+    bot.remove_webhook()
+    bot.infinity_polling(skip_pending=True)
 
 
 